@@ -20,10 +20,20 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 
-from ConfigParser import SafeConfigParser
+import os
+
+try:
+    from configparser import DEFAULTSECT, ConfigParser as SafeConfigParser
+except ImportError:
+    from ConfigParser import DEFAULTSECT, SafeConfigParser
 from argparse import ArgumentParser, Namespace
 
 
+# The argparse keyword arguments (plus split_char) that an Option stores
+_FIELDS = ('action', 'nargs', 'const', 'default', 'type', 'choices',
+           'required', 'help', 'metavar', 'dest', 'split_char')
+
+
 class ConfigArgumentError(Exception):
     pass
 
@@ -40,16 +50,19 @@ def separate_names(names):
     configs = []
     args = []
     options = []
+    add_config = configs.append
+    add_arg = args.append
+    add_option = options.append
 
     for name in names:
-        if name.startswith('-'):
-            options.append(name)
+        if name[:1] == '-':
+            add_option(name)
         elif ':' in name:
-            configs.append(name.split(':'))
+            add_config(tuple(name.split(':', 1)))
         else:
-            args.append(name)
+            add_arg(name)
 
-    return configs, args, options
+    return tuple(configs), tuple(args), tuple(options)
 
 class MissingConfigArgumentError(Exception):
     def __init__(self, option):
@@ -57,6 +70,23 @@ class MissingConfigArgumentError(Exception):
         Exception.__init__(self, 'No configuration value found for required Option(%s)' % 
             formatted_options)
 
+class _MissingConfigValue(object):
+    """
+    Placeholder for a required Option that had no value in the config file.
+    The MissingConfigArgumentError is only built if the placeholder is still
+    present after commandline parsing, or if it is displayed (for instance as
+    the default in --help).
+    """
+    __slots__ = ('option',)
+
+    def __init__(self, option):
+        self.option = option
+
+    def __str__(self):
+        return str(MissingConfigArgumentError(self.option))
+
+    __repr__ = __str__
+
 class Option(object):
     """
     An object that encapsulates a description of a configuration option.
@@ -69,33 +99,32 @@ class Option(object):
     Valid keyword arguments are the keyword arguments from argparse.ArgumentParser.add_argument, except the following:
         * split_char: The string used to split a list of arguments read from the
             configuration file, if nargs is not None. Default is ','
+
+    The keyword arguments are stored as attributes of the same name, and may be changed
+    after construction; comparisons and config parsing always use their current values.
+    The names (config_paths, args and options) should not be changed once the Option
+    has been added to a ConfigBackedArgumentParser, as it indexes Options by them.
     """
 
+    __slots__ = _FIELDS + ('config_paths', 'args', 'options')
+
     _defaults = {
         'action': 'store',
         'split_char': ',',
     }
 
     def __init__(self, *names, **kwargs):
-
-        def read_with_default(key):
-            return kwargs.get(key, self._defaults.get(key))
-
-        self.action = read_with_default('action')
-        self.nargs = read_with_default('nargs')
-        self.const = read_with_default('const')
-        self.default = read_with_default('default')
-        self.type = read_with_default('type')
-        self.choices = read_with_default('choices')
-        self.required = read_with_default('required')
-        self.help = read_with_default('help')
-        self.metavar = read_with_default('metavar')
-        self.dest = read_with_default('dest')
-        self.split_char = read_with_default('split_char')
+        attrs = self._defaults.copy()
+        attrs.update(kwargs)
+        for field in _FIELDS:
+            setattr(self, field, attrs.get(field))
 
         self.config_paths, self.args, self.options = separate_names(names)
 
     def __eq__(self, other):
+        if self is other:
+            return True
+
         return (isinstance(other, Option) and
                 other.action == self.action and
                 other.nargs == self.nargs and
@@ -112,6 +141,13 @@ class Option(object):
                 other.args == self.args and
                 other.options == self.options)
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        # Only hash the names, as values such as choices and default may be unhashable
+        return hash((self.config_paths, self.args, self.options))
+
     def _get_value(self, value):
         """
         Interpret value using the specified type of the Option
@@ -119,20 +155,51 @@ class Option(object):
         if self.type is None:
             return value
 
+        self._check_type()
+        return self.type(value)
+
+    def _check_type(self):
+        """
+        Verify that the specified type of the Option can be called
+        """
         if not callable(self.type):
             formatted_names = " ".join(
                 self.args +
                 self.options +
-                [':'.join(cp) for cp in self.config_paths]
+                tuple(':'.join(cp) for cp in self.config_paths)
             )
             raise ConfigArgumentError("type is not callable for Option(%s)" % formatted_names)
-        return self.type(value)
 
-    def _check_value(self, value):
+    def _choices_lookup(self):
         """
-        Verify that value is allowed for the Option
+        Return a container to check values against the choices of the Option.
+        A list or tuple of hashable choices is copied into a set, so that checking
+        many values is faster; any other container is used as is.
         """
-        if self.choices is not None and value not in self.choices:
+        if isinstance(self.choices, (list, tuple)):
+            try:
+                return frozenset(self.choices)
+            except TypeError:
+                pass
+        return self.choices
+
+    def _check_value(self, value, choices=None):
+        """
+        Verify that value is allowed for the Option. choices, if supplied, is
+        the result of _choices_lookup
+        """
+        if self.choices is None:
+            return
+
+        if choices is None:
+            valid = value in self.choices
+        else:
+            try:
+                valid = value in choices
+            except TypeError:
+                valid = value in self.choices
+
+        if not valid:
             raise ConfigArgumentError("invalid choice: %s (choose from %s)" %
                 (value, ", ".join(repr(c) for c in self.choices)))
 
@@ -149,6 +216,17 @@ class Option(object):
 
         return None, None, None
 
+    def _missing_value(self):
+        """
+        Return the value to use for this Option when it isn't in the config file:
+        a _MissingConfigValue (to be reported later) if the value is required,
+        otherwise the specified default.
+        """
+        if self.required:
+            return _MissingConfigValue(self)
+        else:
+            return self.default
+
     def from_config(self, config_parser):
         """
         Read the value for this Option from config_parser, and return it.
@@ -156,31 +234,65 @@ class Option(object):
         MissingConfigArgumentError (to be raised later), otherwise return
         the specified default.
         """
-        val, section, name = self._read_config_paths(config_parser)
+        value = self._config_value(*self._read_config_paths(config_parser))
+        if isinstance(value, _MissingConfigValue):
+            return MissingConfigArgumentError(value.option)
+        return value
+
+    def _config_value(self, val, section, name):
+        """
+        Return the value for this Option, given val, the raw value read from
+        [section] name in the config file, or None if no value was found
+        """
         if val is None:
-            if self.required:
-                return MissingConfigArgumentError(self)
-            else:
-                return self.default
+            return self._missing_value()
+
+        return self._interpret(val, section, name)
 
+    def _interpret(self, val, section, name):
+        """
+        Convert val, the raw value read from [section] name in the config file,
+        using the nargs, split_char, type and choices of this Option
+        """
         if self.nargs is not None:
-            value = [self._get_value(v.strip()) for v in val.split(self.split_char)]
+            convert = self.type
+            if convert is None:
+                value = [v.strip() for v in val.split(self.split_char)]
+            else:
+                self._check_type()
+                value = [convert(v.strip()) for v in val.split(self.split_char)]
 
-            if self.nargs == '+':
+            nargs = self.nargs
+            if nargs == '+':
                 if len(value) == 0:
                     raise ConfigArgumentError(
                         "Require at least one value in [%s] %s, because nargs='+'"
                         % (section, name))
-            elif self.nargs == '*':
-                pass
-            else:
-                if len(value) != int(self.nargs):
+            elif nargs == '?':
+                if len(value) > 1:
+                    raise ConfigArgumentError(
+                        "Require at most one value in [%s] %s, because nargs='?'"
+                        % (section, name))
+            elif nargs != '*':
+                try:
+                    count = int(nargs)
+                except (TypeError, ValueError):
+                    raise ConfigArgumentError(
+                        "Can't read [%s] %s from the config file, because nargs=%s"
+                        % (section, name, nargs))
+                if len(value) != count:
                     raise ConfigArgumentError(
                         "Require exactly %s values in [%s] %s, because nargs=%s"
-                        % (self.nargs, section, name, self.nargs))
+                        % (nargs, section, name, nargs))
+
+            if self.choices is not None:
+                check_value = self._check_value
+                choices = self._choices_lookup()
+                for v in value:
+                    check_value(v, choices)
 
-            for v in value:
-                self._check_value(v)
+            if nargs == '?':
+                value = value[0]
         else:
             value = self._get_value(val)
             self._check_value(value)
@@ -192,35 +304,41 @@ class Option(object):
         Add this Option to argparser, with from_config as the default.
         If there is no commandline specified form this Option, add
         from_config to the specified namespace instead.
+
+        Returns a list of the names of the attributes the value will be stored in.
         """
         if not (self.args or self.options):
+            if self.dest is None:
+                dests = ["_".join(path) for path in self.config_paths]
+            else:
+                dests = [self.dest]
+
             if namespace is not None:
-                if self.dest is None:
-                    for path in self.config_paths:
-                        setattr(namespace, "_".join(path), from_config)
-                else:
-                    setattr(namespace, self.dest, from_config)
-            return 
-
-        kwargs = {}
-
-        def add_if_not_none(name, value):
-            if value is None:
-                return
-            kwargs[name] = value
-
-        add_if_not_none('action', self.action)
-        add_if_not_none('nargs', self.nargs)
-        add_if_not_none('const', self.const)
-        add_if_not_none('default', from_config)
-        add_if_not_none('type', self.type)
-        add_if_not_none('choices', self.choices)
-        add_if_not_none('required', self.required)
-        add_if_not_none('help', self.help)
-        add_if_not_none('metavar', self.metavar)
-        add_if_not_none('dest', self.dest)
-
-        argparser.add_argument(*(self.args + self.options), **kwargs)
+                for dest in dests:
+                    setattr(namespace, dest, from_config)
+            return dests
+
+        kwargs = {name: value for name, value in (
+            ('action', self.action),
+            ('nargs', self.nargs),
+            ('const', self.const),
+            ('default', from_config),
+            ('type', self.type),
+            ('choices', self.choices),
+            ('required', self.required),
+            ('help', self.help),
+            ('metavar', self.metavar),
+            ('dest', self.dest),
+        ) if value is not None}
+
+        return [argparser.add_argument(*(self.args + self.options), **kwargs).dest]
+
+def _overrides(option, method):
+    """
+    Return whether option is an instance of a subclass of Option that overrides
+    the named method
+    """
+    return getattr(type(option), method) != getattr(Option, method)
 
 
 class ConfigBackedArgumentParser(object):
@@ -254,30 +372,92 @@ class ConfigBackedArgumentParser(object):
         self.parser_args = parser_args
         self.parser_kwargs = parser_kwargs
         self.options = []
+        self._options_seen = set()
+        self._options_seen_list = []
         self.additional_configs = []
+        self._config_cache = None
+        self._bootstrap_parser = None
 
     def _read_config_args(self, args=None):
         """
         Read arguments from the config file. Returns a dictionary mapping Options
         to the values read from the config file for them.
         """
-        parser = ArgumentParser(add_help=False, *self.parser_args, **self.parser_kwargs)
-        self._add_config_arg(parser)
-        opts, left = parser.parse_known_args(args)
+        if self._bootstrap_parser is None:
+            self._bootstrap_parser = ArgumentParser(
+                add_help=False, *self.parser_args, **self.parser_kwargs)
+            self._add_config_arg(self._bootstrap_parser)
+        opts, left = self._bootstrap_parser.parse_known_args(args)
 
-        config = SafeConfigParser()
+        paths = self.additional_configs
         if opts.config is not None:
-            config.read(opts.config)
-        
-        for cfg in self.additional_configs:
-            config.read(cfg)
+            paths = [opts.config] + paths
+        config = self._load_config(paths)
 
+        found = self._find_config_paths(config)
         config_vals = {}
         for opt in self.options:
-            config_vals[opt] = opt.from_config(config)
+            if _overrides(opt, 'from_config') or _overrides(opt, '_read_config_paths'):
+                config_vals[opt] = opt.from_config(config)
+            else:
+                section, name = found.get(opt, (None, None))
+                val = None if section is None else config.get(section, name)
+                config_vals[opt] = opt._config_value(val, section, name)
 
         return config_vals
 
+    def _find_config_paths(self, config):
+        """
+        Return a dictionary mapping each Option to the (section, name) of the first
+        of its config_paths that is present in config. Options with none of their
+        config_paths present are left out.
+
+        This walks the keys of the referenced sections in config once, rather than
+        asking config about every config path of every Option.
+        """
+        lookup = {}
+        for opt in self.options:
+            for priority, (section, name) in enumerate(opt.config_paths):
+                key = (section, config.optionxform(name))
+                lookup.setdefault(key, []).append((priority, opt, name))
+        referenced = set(section for section, _ in lookup)
+
+        sections = [(DEFAULTSECT, config.defaults())]
+        sections.extend((section, config.options(section))
+                        for section in config.sections() if section in referenced)
+
+        found = {}
+        for section, names in sections:
+            for key in names:
+                for priority, opt, name in lookup.get((section, key), ()):
+                    if opt not in found or priority < found[opt][0]:
+                        found[opt] = (priority, section, name)
+
+        return dict((opt, (section, name)) for opt, (_, section, name) in found.items())
+
+    def _load_config(self, paths):
+        """
+        Return a SafeConfigParser that has read all of the files in paths that exist.
+        The parser is reused for as long as none of those files have changed, so that
+        repeated parses (such as bootstrap_parse followed by parse_args) only read
+        the config files once.
+        """
+        key = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key.append((path, stat.st_mtime, stat.st_size))
+        key = tuple(key)
+
+        if self._config_cache is None or self._config_cache[0] != key:
+            config = SafeConfigParser()
+            config.read([path for path, _, _ in key])
+            self._config_cache = (key, config)
+
+        return self._config_cache[1]
+
     def _add_config_arg(self, parser):
         """
         Add the configuration file commandline argument to the specified argument parser
@@ -292,30 +472,54 @@ class ConfigBackedArgumentParser(object):
 
     def _add_options(self, parser, args=None, namespace=None):
         """
-        Add all Options to the specified parser, with defaults from the config file
+        Add all Options to the specified parser, with defaults from the config file.
+        Returns the names of the arguments that are required, but had no value in
+        the config file, or None if all arguments need to be checked
         """
+        if not self.options:
+            return []
+
         config_vals = self._read_config_args(args)
+        missing = []
         for opt in self.options:
-            opt.add_to_parser(parser, from_config=config_vals.get(opt), namespace=namespace)
+            value = config_vals.get(opt)
+            dests = opt.add_to_parser(parser, from_config=value, namespace=namespace)
+            if isinstance(value, (_MissingConfigValue, MissingConfigArgumentError)):
+                if dests is None:
+                    # add_to_parser is overridden and doesn't report where it
+                    # stored the value, so every argument has to be checked
+                    missing = None
+                elif missing is not None:
+                    missing.extend(dests)
+        return missing
 
     def _setup_parser(self, parser, args=None):
         """
         Sets up parser to be used with the config arguments, and returns a namespace
-        that can be passed to parser.parse_args or parser.parse_known_args
+        that can be passed to parser.parse_args or parser.parse_known_args, along with
+        the list of argument names to pass to _check_required_config
         """
         self._add_config_arg(parser)
 
         namespace = Namespace()
-        self._add_options(parser, args, namespace)
-        return namespace
+        missing = self._add_options(parser, args, namespace)
+        return namespace, missing
 
-    def _check_required_config(self, args):
+    def _check_required_config(self, args, dests):
         """
-        If any of the specified arguments are required, and weren't available
-        either from the config file or the commandline, raise the MissingConfigArgumentError
+        If any of the arguments named in dests (or any argument at all, if dests
+        is None) are required, and weren't available either from the config file
+        or the commandline, raise the MissingConfigArgumentError
         """
-        for attr, value in vars(args).items():
-            if isinstance(value, MissingConfigArgumentError):
+        if dests is None:
+            values = vars(args).values()
+        else:
+            values = (getattr(args, dest, None) for dest in dests)
+
+        for value in values:
+            if isinstance(value, _MissingConfigValue):
+                raise MissingConfigArgumentError(value.option)
+            elif isinstance(value, MissingConfigArgumentError):
                 raise value
 
     def parse_known_args(self, args=None):
@@ -324,9 +528,9 @@ class ConfigBackedArgumentParser(object):
         of (the parsed arguments, the remaining arguments)
         """
         parser = ArgumentParser(*self.parser_args, **self.parser_kwargs)
-        namespace = self._setup_parser(parser, args)
+        namespace, missing = self._setup_parser(parser, args)
         args, rest = parser.parse_known_args(args, namespace)
-        self._check_required_config(args)
+        self._check_required_config(args, missing)
         return args, rest
 
     def parse_args(self, args=None):
@@ -335,9 +539,9 @@ class ConfigBackedArgumentParser(object):
         arguments, or raising an exception if there are unknown arguments
         """
         parser = ArgumentParser(*self.parser_args, **self.parser_kwargs)
-        namespace = self._setup_parser(parser, args)
+        namespace, missing = self._setup_parser(parser, args)
         args = parser.parse_args(args, namespace)
-        self._check_required_config(args)
+        self._check_required_config(args, missing)
         return args
 
     def bootstrap_parse(self, args=None):
@@ -346,16 +550,23 @@ class ConfigBackedArgumentParser(object):
         the --help argument. Returns the parsed arguments
         """
         parser = ArgumentParser(add_help=False, *self.parser_args, **self.parser_kwargs)
-        namespace = self._setup_parser(parser, args)
+        namespace, missing = self._setup_parser(parser, args)
         args = parser.parse_known_args(args, namespace)[0]
-        self._check_required_config(args)
+        self._check_required_config(args, missing)
         return args
     
     def append_option(self, option):
         """
         Add a single option to this parser, if the option hasn't already been added
         """
-        if option not in self.options:
+        if self._options_seen_list != self.options:
+            # self.options has been changed directly, so rebuild the set from it
+            self._options_seen = set(self.options)
+            self._options_seen_list = list(self.options)
+
+        if option not in self._options_seen:
+            self._options_seen.add(option)
+            self._options_seen_list.append(option)
             self.options.append(option)
     
     def extend_options(self, options):
@@ -363,5 +574,4 @@ class ConfigBackedArgumentParser(object):
         Add a list of options to this parser, ignoring any that have already been added
         """
         for option in options:
-            if option not in self.options:
-                self.options.append(option)
+            self.append_option(option)